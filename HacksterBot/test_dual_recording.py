@@ -4,14 +4,17 @@ Simplified dual user recording test for HacksterBot.
 Tests if two people speaking simultaneously still causes lag.
 """
 
+import concurrent.futures
+import functools
 import os
 import tempfile
 import time
-import threading
 import math
 import logging
 from unittest.mock import Mock
 
+import numpy as np
+
 # Add project root to path
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -21,24 +24,39 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 
+SAMPLE_RATE = 48000
+
+# Per-packet budget for sink.write on the receive thread. The average budget
+# matches the old 1s tolerance spread over 250 packets; no single write may
+# take longer than one 20ms packet interval.
+WRITE_BUDGET_AVG_S = 0.004
+WRITE_BUDGET_MAX_S = 0.02
+
+
+@functools.lru_cache(maxsize=32)
+def _cycle(frequency: int, amplitude: int = 8000) -> np.ndarray:
+    """Return exactly one period of a mono 16-bit tone at the given frequency."""
+    period = SAMPLE_RATE // math.gcd(SAMPLE_RATE, frequency)
+    t = np.arange(period, dtype=np.float64) / SAMPLE_RATE
+    cycle = (amplitude * np.sin(2 * np.pi * frequency * t)).astype('<i2')
+    cycle.flags.writeable = False
+    return cycle
+
+
+@functools.lru_cache(maxsize=64)
 def create_mock_pcm_data(frequency: int, duration_ms: int, amplitude: int = 8000) -> bytes:
-    """Create mock PCM audio data for testing."""
-    sample_rate = 48000
-    channels = 2
-    duration_seconds = duration_ms / 1000.0
-    num_samples = int(sample_rate * duration_seconds)
-    
-    pcm_data = bytearray()
-    for i in range(num_samples):
-        sample_time = i / sample_rate
-        sample_value = int(amplitude * math.sin(2 * math.pi * frequency * sample_time))
-        
-        # 16-bit stereo PCM
-        sample_bytes = sample_value.to_bytes(2, byteorder='little', signed=True)
-        pcm_data.extend(sample_bytes)  # Left channel
-        pcm_data.extend(sample_bytes)  # Right channel
-    
-    return bytes(pcm_data)
+    """Create mock PCM audio data for testing.
+
+    Results are memoized; the returned bytes are immutable and safe to share
+    between speaker threads. Samples come from a tiled single cycle, so they
+    may differ by ±1 LSB from evaluating sin() at each sample index.
+    """
+    need = int(SAMPLE_RATE * duration_ms / 1000)
+    mono = np.resize(_cycle(frequency, amplitude), need)
+
+    # 16-bit stereo PCM: broadcast the mono samples to both channels and let
+    # tobytes() emit the interleaved frames in a single pass
+    return np.broadcast_to(mono[:, None], (need, 2)).tobytes()
 
 
 def test_dual_user_recording():
@@ -50,7 +68,9 @@ def test_dual_user_recording():
     try:
         from modules.recording.services.meeting_recorder import OptimizedMultiTrackSink
         
-        with tempfile.TemporaryDirectory() as temp_dir:
+        # Prefer tmpfs so the test measures the recording pipeline, not the disk
+        base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        with tempfile.TemporaryDirectory(dir=base_dir) as temp_dir:
             logger.info(f"📁 Test directory: {temp_dir}")
             
             # Create the optimized recording sink
@@ -70,11 +90,15 @@ def test_dual_user_recording():
             
             start_time = time.time()
             total_packets = 0
+            write_latencies = {}  # name -> (avg seconds, max seconds) per write
             
             def speaker_simulation(user, frequency, name):
                 """Simulate a user speaking."""
                 nonlocal total_packets
                 packets_sent = 0
+                write_total = 0.0
+                write_max = 0.0
+                deadline = time.monotonic()
                 
                 for chunk_idx in range(250):  # 250 chunks × 20ms = 5 seconds
                     # Create mock voice data with different frequencies
@@ -82,35 +106,39 @@ def test_dual_user_recording():
                     mock_voice_data.pcm = create_mock_pcm_data(frequency, 20)
                     
                     # Write to sink (this is where lag would occur)
+                    write_start = time.perf_counter()
                     sink.write(user, mock_voice_data)
+                    write_time = time.perf_counter() - write_start
+                    write_total += write_time
+                    write_max = max(write_max, write_time)
                     packets_sent += 1
                     total_packets += 1
                     
-                    # Realistic Discord timing
-                    time.sleep(0.02)  # 20ms intervals (Discord standard)
+                    # Realistic Discord timing: pace against a monotonic deadline
+                    # so 20ms intervals (Discord standard) do not drift with work
+                    deadline += 0.02
+                    time.sleep(max(0, deadline - time.monotonic()))
                 
+                write_latencies[name] = (write_total / packets_sent, write_max)
                 logger.info(f"   {name} sent {packets_sent} packets")
             
             # Start both users speaking simultaneously
-            alice_thread = threading.Thread(
-                target=speaker_simulation, 
-                args=(user1, 440, "Alice"),  # A4 note
-                name="Alice-Speaker"
-            )
-            
-            bob_thread = threading.Thread(
-                target=speaker_simulation, 
-                args=(user2, 330, "Bob"),    # E4 note
-                name="Bob-Speaker"
-            )
-            
-            # Launch both threads at the same time
-            alice_thread.start()
-            bob_thread.start()
-            
-            # Wait for both to finish
-            alice_thread.join()
-            bob_thread.join()
+            speakers = [
+                (user1, 440, "Alice"),  # A4 note
+                (user2, 330, "Bob"),    # E4 note
+            ]
+            
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(speakers), thread_name_prefix="Speaker"
+            ) as executor:
+                futures = [
+                    executor.submit(speaker_simulation, user, frequency, name)
+                    for user, frequency, name in speakers
+                ]
+                
+                # Wait for both to finish, re-raising any speaker failure
+                for future in futures:
+                    future.result()
             
             total_time = time.time() - start_time
             
@@ -120,7 +148,11 @@ def test_dual_user_recording():
             logger.info(f"   • Total packets sent: {total_packets}")
             logger.info(f"   • Total time: {total_time:.3f}s")
             logger.info(f"   • Expected time: ~5.0s")
-            logger.info(f"   • Time overhead: {(total_time - 5.0):.3f}s")
+            for name, (write_avg, write_max) in write_latencies.items():
+                logger.info(
+                    f"   • {name} write latency: avg {write_avg * 1000:.2f}ms, "
+                    f"max {write_max * 1000:.2f}ms"
+                )
             logger.info(f"   • Packets per second: {total_packets/total_time:.1f}")
             logger.info(f"   • Active user buffers: {len(sink.user_buffers)}")
             
@@ -132,7 +164,12 @@ def test_dual_user_recording():
             logger.info(f"   • Packet loss rate: {packet_loss_rate:.2f}%")
             
             # Lag assessment
-            is_real_time = total_time <= 6.0  # Allow 1s tolerance
+            # Pacing absorbs write time into the 20ms sleep, so judge lag on
+            # the measured write latency rather than on total wall time
+            is_real_time = all(
+                write_avg <= WRITE_BUDGET_AVG_S and write_max <= WRITE_BUDGET_MAX_S
+                for write_avg, write_max in write_latencies.values()
+            )
             low_packet_loss = packet_loss_rate < 2.0
             
             logger.info(f"\n🔍 Lag Analysis:")
@@ -150,7 +187,7 @@ def test_dual_user_recording():
             else:
                 logger.warning("\n⚠️ WARNING: Potential lag detected!")
                 if not is_real_time:
-                    logger.warning("   Recording took longer than expected (possible lag)")
+                    logger.warning("   sink.write exceeded the per-packet latency budget (possible lag)")
                 if not low_packet_loss:
                     logger.warning("   High packet loss rate detected")
                 return False